@@ -1,5 +1,5 @@
 // Package npyio is a fork of github.com/sbinet/npyio that is
-// hard-coded for []float32s to avoid reflection.
+// hard-coded for []float32s and []uint8s to avoid reflection.
 package npyio
 
 import (
@@ -13,7 +13,7 @@ import (
 var order = binary.LittleEndian
 
 func Write(w io.Writer, v []float32) error {
-	if err := writeHeader(w, len(v)); err != nil {
+	if err := writeHeader(w, "<f4", len(v)); err != nil {
 		return err
 	}
 
@@ -29,6 +29,15 @@ func Write(w io.Writer, v []float32) error {
 	return nil
 }
 
+func WriteUint8s(w io.Writer, v []uint8) error {
+	if err := writeHeader(w, "|u1", len(v)); err != nil {
+		return err
+	}
+
+	_, err := w.Write(v)
+	return err
+}
+
 // The following is adapted from: github.com/sbinet/npyio
 var magic = [6]byte{'\x93', 'N', 'U', 'M', 'P', 'Y'}
 
@@ -37,7 +46,7 @@ const (
 	minorVersion = byte(0)
 )
 
-func writeHeader(w io.Writer, numElements int) error {
+func writeHeader(w io.Writer, descr string, numElements int) error {
 	if err := binary.Write(w, order, magic[:]); err != nil {
 		return err
 	}
@@ -50,8 +59,8 @@ func writeHeader(w io.Writer, numElements int) error {
 
 	buf := new(bytes.Buffer)
 	fmt.Fprintf(buf,
-		"{'descr': '<f4', 'fortran_order': False, 'shape': (%d,), }",
-		numElements)
+		"{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }",
+		descr, numElements)
 
 	var hdrSize = 6 + len(magic)
 	padding := (hdrSize + buf.Len() + 1) % 16
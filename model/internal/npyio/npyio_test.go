@@ -0,0 +1,73 @@
+package npyio
+
+import (
+	"bytes"
+	"encoding/binary"
+	"math"
+	"strings"
+	"testing"
+)
+
+// readHeader checks the npy magic string and version written by writeHeader,
+// and returns the header dictionary and the array data that follows it.
+func readHeader(t *testing.T, b []byte) (string, []byte) {
+	t.Helper()
+	if len(b) < 12 || !bytes.Equal(b[:6], magic[:]) {
+		t.Fatalf("missing npy magic string: %q", b)
+	}
+	if b[6] != majorVersion || b[7] != minorVersion {
+		t.Fatalf("npy version %d.%d, expected %d.%d", b[6], b[7], majorVersion, minorVersion)
+	}
+	hdrLen := int(order.Uint32(b[8:12]))
+	if len(b) < 12+hdrLen {
+		t.Fatalf("header length %d exceeds data length %d", hdrLen, len(b)-12)
+	}
+	hdr := string(b[12 : 12+hdrLen])
+	if !strings.HasSuffix(hdr, "\n") {
+		t.Errorf("header %q does not end with a newline", hdr)
+	}
+	return strings.TrimRight(hdr, " \n"), b[12+hdrLen:]
+}
+
+func TestWriteUint8s(t *testing.T) {
+	data := []uint8{0, 1, 1, 0, 255}
+	var buf bytes.Buffer
+	if err := WriteUint8s(&buf, data); err != nil {
+		t.Fatal(err)
+	}
+
+	hdr, rest := readHeader(t, buf.Bytes())
+	expected := "{'descr': '|u1', 'fortran_order': False, 'shape': (5,), }"
+	if hdr != expected {
+		t.Errorf("header is %q, expected %q", hdr, expected)
+	}
+	if !bytes.Equal(rest, data) {
+		t.Errorf("data is %v, expected %v", rest, data)
+	}
+}
+
+func TestWrite(t *testing.T) {
+	data := []float32{0, 1.5, -2, float32(math.Inf(1))}
+	var buf bytes.Buffer
+	if err := Write(&buf, data); err != nil {
+		t.Fatal(err)
+	}
+
+	hdr, rest := readHeader(t, buf.Bytes())
+	expected := "{'descr': '<f4', 'fortran_order': False, 'shape': (4,), }"
+	if hdr != expected {
+		t.Errorf("header is %q, expected %q", hdr, expected)
+	}
+	if len(rest) != 4*len(data) {
+		t.Fatalf("%d data bytes, expected %d", len(rest), 4*len(data))
+	}
+	result := make([]float32, len(data))
+	if err := binary.Read(bytes.NewReader(rest), order, result); err != nil {
+		t.Fatal(err)
+	}
+	for i, x := range data {
+		if result[i] != x {
+			t.Errorf("element %d is %v, expected %v", i, result[i], x)
+		}
+	}
+}
@@ -2,12 +2,13 @@ package npyio
 
 import (
 	"bufio"
+	"io"
 	"os"
 
 	"github.com/klauspost/compress/zip"
 )
 
-func MakeNPZ(output string, entries map[string][]float32) error {
+func MakeNPZ(output string, f32Entries map[string][]float32, u8Entries map[string][]uint8) error {
 	f, err := os.Create(output)
 	if err != nil {
 		return err
@@ -19,10 +20,8 @@ func MakeNPZ(output string, entries map[string][]float32) error {
 	z := zip.NewWriter(b)
 	defer z.Close()
 
-	for name, data := range entries {
-		// Custom header so that we do not compress (Method 0=Store).
-		hdr := zip.FileHeader{Name: name}
-		w, err := z.CreateHeader(&hdr)
+	for name, data := range f32Entries {
+		w, err := createEntry(z, name)
 		if err != nil {
 			return err
 		}
@@ -32,5 +31,22 @@ func MakeNPZ(output string, entries map[string][]float32) error {
 		}
 	}
 
+	for name, data := range u8Entries {
+		w, err := createEntry(z, name)
+		if err != nil {
+			return err
+		}
+
+		if err := WriteUint8s(w, data); err != nil {
+			return err
+		}
+	}
+
 	return nil
 }
+
+func createEntry(z *zip.Writer, name string) (io.Writer, error) {
+	// Custom header so that we do not compress (Method 0=Store).
+	hdr := zip.FileHeader{Name: name}
+	return z.CreateHeader(&hdr)
+}
@@ -0,0 +1,61 @@
+package npyio
+
+import (
+	"io/ioutil"
+	"os"
+	"path/filepath"
+	"testing"
+
+	"github.com/klauspost/compress/zip"
+)
+
+func TestMakeNPZ(t *testing.T) {
+	dir, err := ioutil.TempDir("", "npyio")
+	if err != nil {
+		t.Fatal(err)
+	}
+	defer os.RemoveAll(dir)
+
+	output := filepath.Join(dir, "test.npz")
+	f32Entries := map[string][]float32{"Y_value": {0.5, -1}}
+	u8Entries := map[string][]uint8{"X_hands": {0, 1, 0}, "X_history": {1}}
+	if err := MakeNPZ(output, f32Entries, u8Entries); err != nil {
+		t.Fatal(err)
+	}
+
+	r, err := zip.OpenReader(output)
+	if err != nil {
+		t.Fatal(err)
+	}
+	defer r.Close()
+
+	expected := map[string]string{
+		"Y_value":   "{'descr': '<f4', 'fortran_order': False, 'shape': (2,), }",
+		"X_hands":   "{'descr': '|u1', 'fortran_order': False, 'shape': (3,), }",
+		"X_history": "{'descr': '|u1', 'fortran_order': False, 'shape': (1,), }",
+	}
+	if len(r.File) != len(expected) {
+		t.Errorf("npz has %d entries, expected %d", len(r.File), len(expected))
+	}
+	for _, zf := range r.File {
+		// train.py memory-maps entries in place, which requires them to be uncompressed.
+		if zf.Method != zip.Store {
+			t.Errorf("entry %s has compression method %d, expected %d (Store)", zf.Name, zf.Method, zip.Store)
+		}
+
+		rc, err := zf.Open()
+		if err != nil {
+			t.Fatal(err)
+		}
+		b, err := ioutil.ReadAll(rc)
+		rc.Close()
+		if err != nil {
+			t.Fatal(err)
+		}
+
+		hdr, _ := readHeader(t, b)
+		if hdr != expected[zf.Name] {
+			t.Errorf("entry %s has header %q, expected %q", zf.Name, hdr, expected[zf.Name])
+		}
+	}
+}
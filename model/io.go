@@ -11,10 +11,12 @@ import (
 func saveTrainingData(batch []Sample, filename string) error {
 	nSamples := len(batch)
 
-	histories := make([]float32, 0, nSamples*gamestate.MaxNumActions*numActionFeatures)
-	hands := make([]float32, 0, nSamples*(3*numCardsInDeck))
-	drawPiles := make([]float32, 0, nSamples*maxCardsInDrawPile*cards.NumTypes)
-	outputMasks := make([]float32, 0, nSamples*outputDimension)
+	// One-hot features and the output mask are stored as uint8 to reduce the size
+	// of the training data on disk and in memory; train.py casts them back to float.
+	histories := make([]uint8, 0, nSamples*gamestate.MaxNumActions*numActionFeatures)
+	hands := make([]uint8, 0, nSamples*(3*numCardsInDeck))
+	drawPiles := make([]uint8, 0, nSamples*maxCardsInDrawPile*cards.NumTypes)
+	outputMasks := make([]uint8, 0, nSamples*outputDimension)
 	yPolicy := make([]float32, 0, nSamples*outputDimension)
 	yValue := make([]float32, 0, nSamples)
 
@@ -32,20 +34,20 @@ func saveTrainingData(batch []Sample, filename string) error {
 
 		EncodeHistory(is.PublicHistory, history)
 		for _, row := range history {
-			histories = append(histories, row...)
+			histories = appendUint8s(histories, row)
 		}
 		encodeHand(is.Hand, hand[:])
-		hands = append(hands, hand[:]...)
+		hands = appendUint8s(hands, hand[:])
 		encodeHand(is.P0PlayedCards, hand[:])
-		hands = append(hands, hand[:]...)
+		hands = appendUint8s(hands, hand[:])
 		encodeHand(is.P1PlayedCards, hand[:])
-		hands = append(hands, hand[:]...)
+		hands = appendUint8s(hands, hand[:])
 		encodeDrawPile(is.DrawPile, drawPile)
 		for _, row := range drawPile {
-			drawPiles = append(drawPiles, row...)
+			drawPiles = appendUint8s(drawPiles, row)
 		}
 		encodeOutputMask(is.DrawPile.Len(), is.AvailableActions, outputMask[:])
-		outputMasks = append(outputMasks, outputMask[:]...)
+		outputMasks = appendUint8s(outputMasks, outputMask[:])
 
 		encodeOutputs(is.DrawPile.Len(), is.AvailableActions, sample.Policy, policy[:])
 		yPolicy = append(yPolicy, policy[:]...)
@@ -53,15 +55,24 @@ func saveTrainingData(batch []Sample, filename string) error {
 	}
 
 	return npyio.MakeNPZ(filename, map[string][]float32{
+		"Y_policy": yPolicy,
+		"Y_value":  yValue,
+	}, map[string][]uint8{
 		"X_history":     histories,
 		"X_hands":       hands,
 		"X_drawpile":    drawPiles,
 		"X_output_mask": outputMasks,
-		"Y_policy":      yPolicy,
-		"Y_value":       yValue,
 	})
 }
 
+func appendUint8s(dst []uint8, src []float32) []uint8 {
+	for _, x := range src {
+		dst = append(dst, uint8(x))
+	}
+
+	return dst
+}
+
 func min(i, j int) int {
 	if i < j {
 		return i
@@ -1,34 +1,37 @@
 import argparse
 import glob
+import json
 import logging
 import os
 import shutil
+import struct
+import zipfile
 
-import tensorflow.compat.v1.keras.backend as K
 from tensorflow.keras.callbacks import (
     EarlyStopping,
     TerminateOnNaN,
     ModelCheckpoint,
 )
 from tensorflow.keras.layers import (
+    Activation,
     Bidirectional,
     Concatenate,
+    Conv1D,
     Dense,
     Dropout,
     Input,
     GRU,
-    LeakyReLU,
-    Multiply,
+    Lambda,
+    Layer,
     Softmax,
 )
+from tensorflow.keras.mixed_precision import experimental as mixed_precision
 from tensorflow.keras.models import Model
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.regularizers import l2
-from tensorflow.keras.utils import plot_model
 from tensorflow.python.compiler.tensorrt import trt_convert
-import matplotlib.pyplot as plt
 import numpy as np
-import tensorflow.compat.v1 as tf
+import tensorflow as tf
 
 # These constants must be kept in sync with the Go code.
 TF_GRAPH_TAG = "serve"
@@ -41,8 +44,120 @@ MAX_CARDS_IN_DRAW_PILE = 13
 MAX_INSERT_POSITIONS = 8
 N_OUTPUTS = 2*NUM_CARD_TYPES + MAX_INSERT_POSITIONS + 1
 
+# Order of the model's inputs and outputs in build_model.
+INPUT_NAMES = ("history", "hands", "drawpile", "output_mask")
+OUTPUT_NAMES = ("policy", "value")
+# Shape of each input and output for a single sample.
+SAMPLE_SHAPES = {
+    "history": (MAX_HISTORY, N_ACTION_FEATURES),
+    "hands": (3*NUM_CARDS_IN_DECK,),
+    "drawpile": (MAX_CARDS_IN_DRAW_PILE, NUM_CARD_TYPES),
+    "output_mask": (N_OUTPUTS,),
+    "policy": (N_OUTPUTS,),
+    "value": (1,),
+}
 
-def build_model(history_shape: tuple, hands_shape: tuple, drawpile_shape: tuple, output_mask_shape: tuple, policy_shape: int):
+
+# Masks the all-zero padding at the end of a sequence input.
+# The first timestep is never masked: cuDNN does not support sequences
+# that are entirely masked (such as the empty history at the start of a
+# game), and keras would fall back to the generic GRU kernel for any
+# batch that contained one.
+class PaddingMask(Layer):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.supports_masking = True
+
+    def call(self, inputs):
+        return inputs
+
+    def compute_mask(self, inputs, mask=None):
+        not_padding = tf.reduce_any(tf.not_equal(inputs, 0), axis=-1)
+        first = tf.ones_like(not_padding[:, :1])
+        return tf.concat([first, not_padding[:, 1:]], axis=1)
+
+
+def mask_logits(inputs):
+    # Give invalid actions a large negative logit, so that they get ~zero
+    # probability after the softmax. (Multiplying the logits by the mask
+    # instead would give them a logit of 0, and therefore nonzero weight.)
+    logits, mask = inputs
+    return logits + (1.0 - mask) * -1e9
+
+
+def cudnn_gru(units: int):
+    # Keras only dispatches to the fused cuDNN kernel if the layer
+    # uses these settings, so pin them rather than rely on the defaults.
+    return GRU(units, activation='tanh', recurrent_activation='sigmoid',
+               recurrent_dropout=0.0, unroll=False, use_bias=True, reset_after=True,
+               return_sequences=False)
+
+
+def leaky_relu(x):
+    # Used as the Dense/Conv1D activation rather than a separate LeakyReLU
+    # layer, so that it can be fused with the matmul and bias add.
+    # Same slope as the keras LeakyReLU layer (tf.nn.leaky_relu defaults to 0.2).
+    return tf.nn.leaky_relu(x, alpha=0.3)
+
+
+def masked_mean(inputs):
+    # Average a sequence over the timesteps that are not padding.
+    sequence, sequence_input = inputs
+    mask = tf.reduce_any(tf.not_equal(sequence_input, 0), axis=-1, keepdims=True)
+    mask = tf.cast(mask, sequence.dtype)
+    return tf.reduce_sum(sequence * mask, axis=1) / tf.maximum(tf.reduce_sum(mask, axis=1), 1)
+
+
+def encode_sequence(sequence_input, features, units: int, sequence_encoder: str):
+    # Encode the per-timestep features of a zero-padded sequence input into
+    # a vector of size 2*units, with either a bidirectional GRU or a stack
+    # of (matmul-only) causal convolutions averaged over the unpadded
+    # timesteps. Causal convolutions never look ahead into the padding.
+    if sequence_encoder == 'conv':
+        conv_relu_1 = Conv1D(2*units, kernel_size=3, padding='causal', activation=leaky_relu)(features)
+        conv_relu_2 = Conv1D(2*units, kernel_size=3, padding='causal', activation=leaky_relu)(conv_relu_1)
+        return Lambda(masked_mean)([conv_relu_2, sequence_input])
+
+    return Bidirectional(cudnn_gru(units))(features)
+
+
+# Clips each gradient to a norm of at most clip_norm before applying it,
+# as Adam(clipnorm=...) would. TF 2.3's LossScaleOptimizer does not support
+# wrapping an optimizer with clipnorm, so under mixed precision the clipping
+# is done here instead, once the gradients have been unscaled.
+# The train and test steps also cast the uint8 input batches (see cast_inputs).
+class ClippedGradientModel(Model):
+    clip_norm = 1.0
+
+    def train_step(self, data):
+        x, y = data
+        x = cast_inputs(x)
+        loss_scaled = isinstance(self.optimizer, mixed_precision.LossScaleOptimizer)
+        with tf.GradientTape() as tape:
+            y_pred = self(x, training=True)
+            loss = self.compiled_loss(y, y_pred, regularization_losses=self.losses)
+            if loss_scaled:
+                loss = self.optimizer.get_scaled_loss(loss)
+        gradients = tape.gradient(loss, self.trainable_variables)
+        if loss_scaled:
+            gradients = self.optimizer.get_unscaled_gradients(gradients)
+        # Non-finite gradients stay non-finite when clipped, so the
+        # LossScaleOptimizer still skips the step and lowers the loss scale.
+        gradients = [tf.clip_by_norm(g, self.clip_norm) for g in gradients]
+        self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+        self.compiled_metrics.update_state(y, y_pred)
+        return {m.name: m.result() for m in self.metrics}
+
+    def test_step(self, data):
+        x, y = data
+        y_pred = self(cast_inputs(x), training=False)
+        self.compiled_loss(y, y_pred, regularization_losses=self.losses)
+        self.compiled_metrics.update_state(y, y_pred)
+        return {m.name: m.result() for m in self.metrics}
+
+
+def build_model(history_shape: tuple, hands_shape: tuple, drawpile_shape: tuple, output_mask_shape: tuple, policy_shape: int,
+                sequence_encoder: str = 'gru', steps_per_execution: int = 1):
     logging.info("Building model")
     logging.info("History input shape: %s", history_shape)
     history_input = Input(name="history", shape=history_shape)
@@ -53,68 +168,132 @@ def build_model(history_shape: tuple, hands_shape: tuple, drawpile_shape: tuple,
     logging.info("Output mask shape: %s", output_mask_shape)
     output_mask_input = Input(name="output_mask", shape=output_mask_shape)
     logging.info("Policy output shape: %s", policy_shape)
+    logging.info("Sequence encoder: %s", sequence_encoder)
+
+    # For the GRUs, padding is masked so that they skip the unused timesteps.
+    # (Conv1D does not support masking; masked_mean handles the padding instead.)
+    history_masked = history_input
+    drawpile_masked = drawpile_input
+    if sequence_encoder == 'gru':
+        history_masked = PaddingMask()(history_input)
+        drawpile_masked = PaddingMask()(drawpile_input)
 
-    # The history (GRU) arm of the model.
-    history_hidden_1 = Dense(32)(history_input)
-    history_relu_1 = LeakyReLU()(history_hidden_1)
-    history_hidden_2 = Dense(16)(history_relu_1)
-    history_relu_2 = LeakyReLU()(history_hidden_2)
-    history_lstm = Bidirectional(GRU(32, return_sequences=False))(history_relu_2)
+    # The history arm of the model.
+    # A single per-timestep projection is enough ahead of the sequence
+    # encoder, which provides the nonlinear capacity.
+    history_relu_1 = Dense(32, activation=leaky_relu)(history_masked)
+    history_lstm = encode_sequence(history_input, history_relu_1, 32, sequence_encoder)
 
-    # The draw pile (GRU) arm of the model.
-    drawpile_hidden_1 = Dense(16)(drawpile_input)
-    drawpile_relu_1 = LeakyReLU()(drawpile_hidden_1)
-    drawpile_hidden_2 = Dense(16)(drawpile_relu_1)
-    drawpile_relu_2 = LeakyReLU()(drawpile_hidden_2)
-    drawpile_lstm = Bidirectional(GRU(16, return_sequences=False))(drawpile_relu_2)
+    # The draw pile arm of the model.
+    drawpile_relu_1 = Dense(16, activation=leaky_relu)(drawpile_masked)
+    drawpile_lstm = encode_sequence(drawpile_input, drawpile_relu_1, 16, sequence_encoder)
 
     # The hands arm of the model.
-    hands_hidden_1 = Dense(32)(hands_input)
-    hands_relu_1 = LeakyReLU()(hands_hidden_1)
-    hands_hidden_2 = Dense(32)(hands_relu_1)
-    hands_relu_2 = LeakyReLU()(hands_hidden_2)
+    hands_relu_1 = Dense(32, activation=leaky_relu)(hands_input)
+    hands_relu_2 = Dense(32, activation=leaky_relu)(hands_relu_1)
 
     # Concatenate history, hand, and draw pile.
     # Then send through some dense layers.
     merged_inputs_1 = Concatenate()([history_lstm, drawpile_lstm, hands_relu_2])
-    merged_hidden_1 = Dense(128)(merged_inputs_1)
-    relu_1 = LeakyReLU()(merged_hidden_1)
+    relu_1 = Dense(128, activation=leaky_relu)(merged_inputs_1)
     dropout_1 = Dropout(0.2)(relu_1)
-    merged_hidden_2 = Dense(128)(dropout_1)
-    relu_2 = LeakyReLU()(merged_hidden_2)
+    relu_2 = Dense(128, activation=leaky_relu)(dropout_1)
+
+    # Both output heads are computed by a single matmul: the first
+    # policy_shape units are the policy logits, and the last is the value.
+    heads_hidden = Dense(policy_shape + 1, activation='linear', kernel_regularizer=l2(0.001))(relu_2)
+    policy_hidden_1 = heads_hidden[:, :policy_shape]
+    value_hidden_1 = heads_hidden[:, policy_shape:]
 
     # Policy output head.
-    policy_hidden_1 = Dense(policy_shape, activation='linear', kernel_regularizer=l2(0.001))(relu_2)
-    policy_masked = Multiply()([policy_hidden_1, output_mask_input])
-    policy_output = Softmax(name='policy')(policy_masked)
+    policy_masked = Lambda(mask_logits, dtype='float32')([policy_hidden_1, output_mask_input])
+    # Outputs are kept in float32 for numerical stability under mixed precision,
+    # and because the Go inference code expects float32 results.
+    policy_output = Softmax(name='policy', dtype='float32')(policy_masked)
     # Value output head.
-    value_output = Dense(1, activation='tanh', name='value', kernel_regularizer=l2(0.001))(relu_2)
+    value_output = Activation('tanh', name='value', dtype='float32')(value_hidden_1)
+
+    # Gradients are clipped by ClippedGradientModel rather than the optimizer.
+    optimizer = Adam()
+    if mixed_precision.global_policy().compute_dtype == 'float16':
+        optimizer = mixed_precision.LossScaleOptimizer(optimizer, loss_scale='dynamic')
 
-    model = Model(
+    model = ClippedGradientModel(
         inputs=[history_input, hands_input, drawpile_input, output_mask_input],
         outputs=[policy_output, value_output])
     model.compile(
         loss=['categorical_crossentropy', 'mean_squared_error'],
-        optimizer=Adam(clipnorm=1.0),
-        metrics=['mean_absolute_error'])
+        optimizer=optimizer,
+        metrics=['mean_absolute_error'],
+        # Run several batches per call into the traced train function,
+        # to amortize the per-step Python and callback overhead.
+        experimental_steps_per_execution=steps_per_execution)
     return model
 
 
 def plot_metrics(history, output):
-    plt.figure()
+    # Imported here so that matplotlib is only loaded when plotting.
+    # Use the object-oriented API rather than pyplot's global figure state.
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    ax = fig.subplots()
     for metric in ['loss', 'val_loss']:
         epochs = np.arange(len(history.history[metric])) + 1
-        plt.plot(epochs, history.history[metric], label=metric)
-    plt.xticks(epochs)
-    plt.legend()
-    plt.title('Training Loss')
-    plt.xlabel('Epoch')
-    plt.ylabel('MSE')
-    plt.savefig(output)
+        ax.plot(epochs, history.history[metric], label=metric)
+    ax.set_xticks(epochs)
+    ax.legend()
+    ax.set_title('Training Loss')
+    ax.set_xlabel('Epoch')
+    ax.set_ylabel('MSE')
+    fig.savefig(output)
+
+
+def save_weights_and_plots(model, history, output: str, plot: bool = False):
+    # Save keras model weights for re-initialization on next iteration.
+    model.save_weights(os.path.join(output, "weights.h5"))
+    if plot:
+        # plot_model pulls in pydot/graphviz, so only import it if needed.
+        from tensorflow.keras.utils import plot_model
+
+        plot_model(model, to_file=os.path.join(output, 'model.pdf'),
+                   show_layer_names=False, show_shapes=True)
+        plot_metrics(history, os.path.join(output, "metrics.pdf"))
+
+
+def mmap_npz(filename: str):
+    # np.load ignores mmap_mode for npz archives. But the Go code writes
+    # entries uncompressed, so we can memory-map each array in place
+    # rather than reading it into (anonymous, per-process) memory.
+    arrays = {}
+    with zipfile.ZipFile(filename) as zf, open(filename, "rb") as f:
+        for info in zf.infolist():
+            name = info.filename
+            if name.endswith(".npy"):
+                name = name[:-len(".npy")]
+
+            if info.compress_type != zipfile.ZIP_STORED:
+                with zf.open(info) as entry:
+                    arrays[name] = np.lib.format.read_array(entry)
+                continue
+
+            # Skip over the local file header to the start of the npy data.
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+            name_len, extra_len = struct.unpack("<HH", local_header[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            arrays[name] = np.memmap(f, dtype=dtype, mode="r", shape=shape,
+                                     order="F" if fortran_order else "C", offset=f.tell())
+    return arrays
 
 
 def load_data(filename: str):
-    batch = np.load(filename)
+    batch = mmap_npz(filename)
     n_samples = len(batch["Y_value"])
     X_history = batch["X_history"].reshape((n_samples, MAX_HISTORY, N_ACTION_FEATURES))
     X_hands = batch["X_hands"].reshape((n_samples, 3*NUM_CARDS_IN_DECK))
@@ -128,6 +307,200 @@ def load_data(filename: str):
     return X, Y
 
 
+def cast_inputs(X):
+    # One-hot inputs are stored as uint8 to save memory and host->device
+    # bandwidth, but the model (and Go inference code) use float inputs.
+    # So the batches stay uint8 in the input pipeline, and are only cast
+    # in the train and test steps, on the device.
+    return tuple(tf.cast(x, tf.float32) for x in X)
+
+
+def split_data(X, Y, validation_split: float):
+    # Hold out the last samples for validation, as keras does for validation_split.
+    n_samples = len(Y["value"])
+    split_at = int(n_samples * (1.0 - validation_split))
+    train = ({k: v[:split_at] for k, v in X.items()}, {k: v[:split_at] for k, v in Y.items()})
+    validation = ({k: v[split_at:] for k, v in X.items()}, {k: v[split_at:] for k, v in Y.items()})
+    return train, validation
+
+
+def count_batches(n_samples: int, batch_size: int, drop_remainder: bool):
+    # keras needs the number of batches per epoch to run more than one step
+    # per execution, but tf.data cannot always count them (it loses track
+    # through TFRecord files and prefetch_to_device, for example).
+    if drop_remainder:
+        return n_samples // batch_size
+    return (n_samples + batch_size - 1) // batch_size
+
+
+def make_dataset(X, Y, batch_size: int, shuffle: bool = False,
+                 prefetch_buffer_size: int = tf.data.experimental.AUTOTUNE):
+    n_samples = len(Y["value"])
+    # Pass inputs and outputs positionally rather than as dicts keyed by layer name.
+    arrays = [X[name] for name in INPUT_NAMES] + [Y[name] for name in OUTPUT_NAMES]
+
+    def gather_batch(idx):
+        # Index the (memory-mapped) arrays directly rather than converting
+        # them to tensors up front, so that the training data is never copied
+        # wholesale into memory; only the pages in use are faulted in.
+        batch = tf.numpy_function(
+            lambda idx: [a[idx] for a in arrays], [idx],
+            [tf.as_dtype(a.dtype) for a in arrays])
+        for t, a in zip(batch, arrays):
+            t.set_shape(idx.shape[:1].concatenate(a.shape[1:]))
+        return tuple(batch[:len(INPUT_NAMES)]), tuple(batch[len(INPUT_NAMES):])
+
+    # Shuffle sample indices rather than the samples themselves, so that the
+    # shuffle buffer does not hold a second copy of all of the training data,
+    # and gather each batch in one op instead of slicing and stacking samples.
+    ds = tf.data.Dataset.range(n_samples)
+    if shuffle:
+        ds = ds.shuffle(n_samples, reshuffle_each_iteration=True)
+    # Drop the ragged final training batch so that every step has the same
+    # static shape (and XLA does not need to compile a second variant),
+    # unless that would leave no training batches at all.
+    drop_remainder = shuffle and n_samples >= batch_size
+    ds = ds.batch(batch_size, drop_remainder=drop_remainder)
+    ds = ds.map(gather_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if not shuffle:
+        # Unshuffled batches are identical every epoch (e.g. validation),
+        # so only gather them once.
+        ds = ds.cache()
+    n_batches = count_batches(n_samples, batch_size, drop_remainder)
+    return optimize_and_prefetch(ds, prefetch_buffer_size), n_batches
+
+
+def optimize_and_prefetch(ds, prefetch_buffer_size: int):
+    # Batch order does not matter for training, so let tf.data
+    # hand out whichever batch is ready first.
+    options = tf.data.Options()
+    options.experimental_deterministic = False
+    ds = ds.with_options(options)
+    # fit is told the number of steps per epoch (see count_batches), so
+    # repeat the dataset rather than rely on keras to restart it each epoch.
+    ds = ds.repeat()
+    ds = ds.prefetch(prefetch_buffer_size)
+    if tf.config.list_physical_devices("GPU"):
+        # Copy the next batches to the GPU while the current step runs.
+        # NB: This must be the last transformation in the pipeline.
+        ds = ds.apply(tf.data.experimental.prefetch_to_device("/gpu:0", buffer_size=2))
+    return ds
+
+
+def write_tfrecords(X, Y, prefix: str, shards: int):
+    # Samples are written to the shards in a random order, so that each
+    # shard (and hence each shuffle buffer when reading) is well mixed.
+    writers = [tf.io.TFRecordWriter("%s-%05d-of-%05d.tfrecords" % (prefix, i, shards))
+               for i in range(shards)]
+    # Convert one sample at a time, rather than whole arrays, so that
+    # the memory-mapped inputs are never copied into memory.
+    arrays = [(name, X[name], np.uint8) for name in INPUT_NAMES]
+    arrays += [(name, Y[name], np.float32) for name in OUTPUT_NAMES]
+    n_samples = len(Y["value"])
+    for i, idx in enumerate(np.random.permutation(n_samples)):
+        example = tf.train.Example(features=tf.train.Features(feature={
+            name: tf.train.Feature(bytes_list=tf.train.BytesList(value=[a[idx].astype(dtype).tobytes()]))
+            for name, a, dtype in arrays
+        }))
+        writers[i % shards].write(example.SerializeToString())
+    for writer in writers:
+        writer.close()
+
+
+def tfrecords_source(filename: str, validation_split: float):
+    # Identifies the npz (and split) that TFRecords were converted from.
+    st = os.stat(filename)
+    return {"input_size": st.st_size, "input_mtime": st.st_mtime, "validation_split": validation_split}
+
+
+def npz_to_tfrecords(filename: str, out_dir: str, validation_split: float, shards: int = 8):
+    # One-time conversion of a training npz to TFRecords that can be
+    # read back in parallel with load_tfrecords.
+    logging.info("Converting %s to TFRecords in %s", filename, out_dir)
+    X, Y = load_data(filename)
+    (X_train, y_train), (X_val, y_val) = split_data(X, Y, validation_split)
+    if os.path.exists(out_dir):
+        # Only ever replace a directory that was written by this function.
+        if read_tfrecords_metadata(out_dir) is None:
+            raise FileExistsError("%s already exists, but does not contain TFRecords "
+                                  "converted by train.py" % out_dir)
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+    # Mark the directory as ours before writing any shards, so that an
+    # interrupted conversion is replaced (rather than used) next time.
+    metadata = tfrecords_source(filename, validation_split)
+    metadata.update(complete=False)
+    write_tfrecords_metadata(out_dir, metadata)
+    write_tfrecords(X_train, y_train, os.path.join(out_dir, "train"), shards)
+    write_tfrecords(X_val, y_val, os.path.join(out_dir, "validation"), 1)
+    metadata.update(complete=True, n_train=len(y_train["value"]), n_validation=len(y_val["value"]))
+    write_tfrecords_metadata(out_dir, metadata)
+    return metadata
+
+
+def write_tfrecords_metadata(out_dir: str, metadata: dict):
+    with open(os.path.join(out_dir, "metadata.json"), "w") as f:
+        json.dump(metadata, f)
+
+
+def read_tfrecords_metadata(out_dir: str):
+    # Returns the metadata written by npz_to_tfrecords, or None if
+    # out_dir does not contain any.
+    try:
+        with open(os.path.join(out_dir, "metadata.json")) as f:
+            metadata = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if not isinstance(metadata, dict) or "complete" not in metadata:
+        return None
+    return metadata
+
+
+def load_tfrecords_metadata(filename: str, out_dir: str, validation_split: float):
+    # Returns the metadata of previously converted TFRecords, or None if they
+    # are missing, incomplete, or were not converted from this input.
+    metadata = read_tfrecords_metadata(out_dir)
+    if metadata is None or not metadata["complete"]:
+        return None
+    source = tfrecords_source(filename, validation_split)
+    if any(metadata.get(k) != v for k, v in source.items()):
+        return None
+    return metadata
+
+
+def parse_examples(serialized):
+    features = {name: tf.io.FixedLenFeature([], tf.string)
+                for name in INPUT_NAMES + OUTPUT_NAMES}
+    parsed = tf.io.parse_example(serialized, features)
+
+    def decode(name, dtype):
+        t = tf.reshape(tf.io.decode_raw(parsed[name], dtype), (-1,) + SAMPLE_SHAPES[name])
+        # Keep the static batch size (from drop_remainder) that the reshape loses.
+        t.set_shape(serialized.shape[:1].concatenate(SAMPLE_SHAPES[name]))
+        return t
+
+    X = tuple(decode(name, tf.uint8) for name in INPUT_NAMES)
+    Y = tuple(decode(name, tf.float32) for name in OUTPUT_NAMES)
+    return X, Y
+
+
+def load_tfrecords(pattern: str, n_samples: int, batch_size: int, shuffle: bool = False,
+                   prefetch_buffer_size: int = tf.data.experimental.AUTOTUNE):
+    ds = tf.data.Dataset.list_files(pattern, shuffle=shuffle)
+    ds = ds.interleave(tf.data.TFRecordDataset,
+                       num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if shuffle:
+        ds = ds.shuffle(16 * batch_size, reshuffle_each_iteration=True)
+    # Batch the serialized examples first, so that they are parsed a batch at a time.
+    drop_remainder = shuffle and n_samples >= batch_size
+    ds = ds.batch(batch_size, drop_remainder=drop_remainder)
+    ds = ds.map(parse_examples, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if not shuffle:
+        ds = ds.cache()
+    n_batches = count_batches(n_samples, batch_size, drop_remainder)
+    return optimize_and_prefetch(ds, prefetch_buffer_size), n_batches
+
+
 def main():
     parser = argparse.ArgumentParser(description="Run training on a batch of advantages samples")
     parser.add_argument("input", help="Input with training data (npz)")
@@ -135,23 +508,44 @@ def main():
     parser.add_argument("--validation_split", type=float, default=0.1,
                         help="Fraction of data to hold out for validation / early-stopping")
     parser.add_argument("--initial_weights", help="Load initial weights from saved model")
+    parser.add_argument("--dtype_policy", default="mixed_float16", choices=["float32", "mixed_float16"],
+                        help="Keras dtype policy to train with")
+    parser.add_argument("--sequence_encoder", default="gru", choices=["gru", "conv"],
+                        help="Layer type used to encode the history and draw pile sequences")
+    parser.add_argument("--no_xla", dest="xla", action="store_false",
+                        help="Disable XLA JIT compilation")
+    parser.add_argument("--batch_size", type=int,
+                        help="Training batch size (default: chosen based on the number of samples)")
+    parser.add_argument("--steps_per_execution", type=int, default=50,
+                        help="Number of batches to run per call to the train function")
+    parser.add_argument("--tfrecords", action="store_true",
+                        help="Train from TFRecords converted from the input (written next to it, "
+                             "and reused while the input and validation split are unchanged)")
+    parser.add_argument("--plot", action="store_true",
+                        help="Save plots of the model and training metrics to the output directory")
+    parser.add_argument("--prefetch_buffer_size", type=int, default=tf.data.experimental.AUTOTUNE,
+                        help="Max number of batches to prefetch on the host (default: autotuned)")
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
 
-    config = tf.ConfigProto(
-      gpu_options=tf.GPUOptions(allow_growth=True),
-    )
-    sess = tf.Session(config=config)
-    K.set_session(sess)
+    for gpu in tf.config.list_physical_devices("GPU"):
+        tf.config.experimental.set_memory_growth(gpu, True)
+    if args.xla:
+        # Let XLA auto-cluster and fuse the small Dense/activation ops.
+        tf.config.optimizer.set_jit(True)
+
+    mixed_precision.set_policy(args.dtype_policy)
 
     X, y = load_data(args.input)
 
-    history_shape = X["history"][0].shape
-    hands_shape = X["hands"][0].shape
-    drawpile_shape = X["drawpile"][0].shape
-    output_mask_shape = X["output_mask"][0].shape
-    policy_shape = y["policy"][0].shape[0]
-    model = build_model(history_shape, hands_shape, drawpile_shape, output_mask_shape, policy_shape)
+    history_shape = X["history"].shape[1:]
+    hands_shape = X["hands"].shape[1:]
+    drawpile_shape = X["drawpile"].shape[1:]
+    output_mask_shape = X["output_mask"].shape[1:]
+    policy_shape = y["policy"].shape[1]
+    model = build_model(history_shape, hands_shape, drawpile_shape, output_mask_shape, policy_shape,
+                        sequence_encoder=args.sequence_encoder,
+                        steps_per_execution=args.steps_per_execution)
     print(model.summary())
     print("Input layer names:", [node.op.name for node in model.inputs])
     print("Output layer names:", [node.op.name for node in model.outputs])
@@ -160,20 +554,41 @@ def main():
         logging.info("Loading initial weights from: %s", args.initial_weights)
         model.load_weights(args.initial_weights)
 
-    # Use batches in largest power of two such that:
-    #   1. At least 128 batches per epoch.
-    #   2. Minimum batch size 32, max 2048.
-    n_samples = len(y["value"])
-    batch_size = 32
-    while batch_size * 128 < n_samples and batch_size < 2048:
-        batch_size *= 2
+    batch_size = args.batch_size
+    if not batch_size:
+        # Use batches in largest power of two such that:
+        #   1. At least 128 batches per epoch.
+        #   2. Minimum batch size 32, max 2048.
+        n_samples = len(y["value"])
+        batch_size = 32
+        while batch_size * 128 < n_samples and batch_size < 2048:
+            batch_size *= 2
     logging.info("Using batch size: %d", batch_size)
+    if args.tfrecords:
+        tfrecords_dir = os.path.splitext(args.input)[0] + ".tfrecords"
+        metadata = load_tfrecords_metadata(args.input, tfrecords_dir, args.validation_split)
+        if metadata is None:
+            metadata = npz_to_tfrecords(args.input, tfrecords_dir, args.validation_split)
+        logging.info("Reading %d training and %d validation samples from %s",
+                     metadata["n_train"], metadata["n_validation"], tfrecords_dir)
+        train_ds, train_steps = load_tfrecords(
+            os.path.join(tfrecords_dir, "train-*"), metadata["n_train"], batch_size, shuffle=True,
+            prefetch_buffer_size=args.prefetch_buffer_size)
+        val_ds, val_steps = load_tfrecords(
+            os.path.join(tfrecords_dir, "validation-*"), metadata["n_validation"], batch_size,
+            prefetch_buffer_size=args.prefetch_buffer_size)
+    else:
+        (X_train, y_train), (X_val, y_val) = split_data(X, y, args.validation_split)
+        train_ds, train_steps = make_dataset(X_train, y_train, batch_size, shuffle=True,
+                                             prefetch_buffer_size=args.prefetch_buffer_size)
+        val_ds, val_steps = make_dataset(X_val, y_val, batch_size,
+                                         prefetch_buffer_size=args.prefetch_buffer_size)
     history = model.fit(
-        x=X,
-        y=y,
-        batch_size=batch_size,
+        train_ds,
+        steps_per_epoch=train_steps,
+        validation_data=val_ds,
+        validation_steps=val_steps,
         epochs=100,
-        validation_split=0.1,
         callbacks=[
             EarlyStopping(
                 monitor='val_loss', min_delta=0.0001, patience=5,
@@ -196,11 +611,7 @@ def main():
     converter.convert()
     logging.info("Saving optimized model to %s", args.output)
     converter.save(args.output)
-    # Save keras model weights for re-initialization on next iteration.
-    model.save_weights(os.path.join(args.output, "weights.h5"))
-    plot_model(model, to_file=os.path.join(args.output, 'model.pdf'),
-               show_layer_names=False, show_shapes=True)
-    plot_metrics(history, os.path.join(args.output, "metrics.pdf"))
+    save_weights_and_plots(model, history, args.output, args.plot)
 
 
 if __name__ == "__main__":
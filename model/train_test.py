@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import numpy as np
+
+from train import mmap_npz
+
+
+class MmapNPZTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.arrays = {
+            "X_history": np.arange(24, dtype=np.uint8).reshape((2, 3, 4)),
+            "X_hands": np.array([0, 1, 1, 0, 255], dtype=np.uint8),
+            "Y_value": np.array([0.5, -1.0, 3.25], dtype=np.float32),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check_matches_np_load(self, filename: str):
+        expected = np.load(filename)
+        result = mmap_npz(filename)
+        self.assertEqual(set(result), set(expected.files))
+        for name in expected.files:
+            self.assertEqual(result[name].dtype, expected[name].dtype, name)
+            np.testing.assert_array_equal(result[name], expected[name], name)
+
+    def test_savez(self):
+        filename = os.path.join(self.dir, "savez.npz")
+        np.savez(filename, **self.arrays)
+        self.check_matches_np_load(filename)
+        # Uncompressed entries are read in place rather than into memory.
+        for a in mmap_npz(filename).values():
+            self.assertIsInstance(a, np.memmap)
+
+    def test_savez_compressed(self):
+        # Compressed entries cannot be memory-mapped, and are read instead.
+        filename = os.path.join(self.dir, "compressed.npz")
+        np.savez_compressed(filename, **self.arrays)
+        self.check_matches_np_load(filename)
+
+    def test_go_npz_format(self):
+        # Like model/internal/npyio: uncompressed entries without a .npy
+        # suffix, each holding a flat array with a version 2.0 npy header.
+        filename = os.path.join(self.dir, "go.npz")
+        with zipfile.ZipFile(filename, "w", compression=zipfile.ZIP_STORED) as zf:
+            for name, a in self.arrays.items():
+                with zf.open(name, "w") as f:
+                    np.lib.format.write_array(f, a.ravel(), version=(2, 0))
+        self.check_matches_np_load(filename)
+
+
+if __name__ == "__main__":
+    unittest.main()